@@ -0,0 +1,388 @@
+"""
+ワーカー数ごとのスループット、および入力中の prefill の有無による TTFT を計測する。
+
+--mode throughput（既定）:
+
+疑似 Ollama サーバーを立て、SQLite セッションバックエンドで `uvicorn --workers N` を起動して
+`/chat` を叩く。クライアントごとに別のセッション（クッキー `chat_session_id`）を使い、
+それぞれに履歴を `--history` 件あらかじめ投入しておく。1リクエストごとに
+履歴の読み込み・Ollama へのペイロード生成・チャット履歴パーシャルの描画という
+CPU 処理が発生するようにしている（遅延待ちだけでは単一ワーカーでも捌けてしまうため）。
+同じ会話への同時送信は互いのターンを中断し合うため、会話はクライアント間で共有しない。
+ワーカー数に応じてスループットが伸びるのは CPU コアが複数ある場合に限られる。
+
+    python scripts/load_test.py --workers 1 2 4 --concurrency 16 --duration 10
+
+--mode ttft:
+プロンプトの先頭一致部分をキャッシュする疑似 Ollama（未キャッシュの文字数に比例して
+評価時間がかかる）を立て、prefill あり / なしのターンを交互に送って TTFT を比較する。
+thinking モデルでは履歴に思考過程が含まれないため、前回の生成結果のキャッシュは
+前回の回答の手前までしか一致しない。prefill はこの差分を送信前に評価させる。
+
+    python scripts/load_test.py --mode ttft --turns 20
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from src.core.chat_session import ChatSession  # noqa: E402
+from src.core.session_backend import SQLiteSessionBackend  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_ollama(latency: float) -> Tuple[ThreadingHTTPServer, str]:
+    """/api/chat に latency 秒かけて応答する疑似 Ollama サーバーを起動する"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                self._send_json({"models": [{"name": "load-test"}]})
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/api/show":
+                self._send_json({"capabilities": ["completion"]})
+            elif self.path == "/api/chat" and not payload.get("stream", True):
+                time.sleep(latency)
+                self._send_json({"message": {"role": "assistant", "content": "ok"}, "done": True})
+            elif self.path == "/api/chat":
+                time.sleep(latency)
+                lines = [
+                    {"message": {"role": "assistant", "content": "ok"}, "done": False},
+                    {"message": {"role": "assistant", "content": ""}, "done": True},
+                ]
+                body = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self.send_error(404)
+
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_prefix_cache_ollama(eval_cost: float, reply_size: int) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    KV キャッシュを模した疑似 Ollama サーバーを起動する。
+    直前に評価した系列と先頭が一致しない部分だけ、1文字あたり eval_cost 秒の評価時間がかかる。
+    """
+    state = {"cache": ""}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, payload) -> None:
+            line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+
+        def do_GET(self):
+            self._send_json({"models": [{"name": "load-test"}]})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/api/show":
+                self._send_json({"capabilities": ["completion", "thinking"]})
+                return
+
+            prompt = "".join(f"<{m['role']}>{m['content']}" for m in payload.get("messages", []))
+            prefill = payload.get("options", {}).get("num_predict") == 1
+            thinking = "考" * reply_size
+            reply = "答" * reply_size
+
+            # Ollama は1リクエストずつ処理する
+            with lock:
+                cache = state["cache"]
+                common = len(os.path.commonprefix([cache, prompt]))
+                time.sleep((len(prompt) - common) * eval_cost)
+                state["cache"] = prompt if prefill else prompt + "<assistant>" + thinking + reply
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                if not prefill:
+                    self._write_chunk({"message": {"content": "", "thinking": thinking}, "done": False})
+                    self._write_chunk({"message": {"content": reply}, "done": False})
+                self._write_chunk({"message": {"content": ""}, "done": True})
+                self.wfile.write(b"0\r\n\r\n")
+
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def session_id_for(client: int) -> str:
+    return f"load-{client}"
+
+
+def seed_history(db_path: str, clients: int, count: int, size: int) -> int:
+    """クライアントごとのセッションに履歴を投入し、投入後の最大メッセージIDを返す"""
+    backend = SQLiteSessionBackend(db_path)
+    for client in range(clients):
+        session = ChatSession(backend=backend, session_id=session_id_for(client))
+        for i in range(count // 2):
+            session.add_user(f"質問 {i} " + "あ" * size)
+            session.add_assistant(f"回答 {i} " + "い" * size)
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+
+def trim_history(db_path: str, seed_max_id: int, stop: threading.Event) -> None:
+    """計測中に追加されたメッセージを消し、1リクエストあたりの処理量を一定に保つ"""
+    with sqlite3.connect(db_path, timeout=5) as conn:
+        while not stop.wait(0.2):
+            with conn:
+                conn.execute("DELETE FROM messages WHERE id > ?", (seed_max_id,))
+
+
+def wait_until_ready(base_url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{base_url}/static/js/main.js", timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+def run_load(base_url: str, concurrency: int, duration: float) -> Tuple[int, int]:
+    """concurrency 本のスレッドで duration 秒間リクエストを送り、(成功数, 失敗数) を返す"""
+    deadline = time.monotonic() + duration
+    counts = {"ok": 0, "error": 0}
+    lock = threading.Lock()
+    body = urllib.parse.urlencode({"user_input": "hello"}).encode("utf-8")
+
+    def worker(client: int) -> None:
+        headers = {"Cookie": f"chat_session_id={session_id_for(client)}"}
+        while time.monotonic() < deadline:
+            try:
+                request = urllib.request.Request(f"{base_url}/chat", data=body, headers=headers, method="POST")
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    ok = response.status == 200 and "エラー" not in response.read().decode("utf-8")[-2000:]
+                key = "ok" if ok else "error"
+            except OSError:
+                key = "error"
+            with lock:
+                counts[key] += 1
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts["ok"], counts["error"]
+
+
+def measure(workers: int, ollama_url: str, args: argparse.Namespace) -> float:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "sessions.sqlite3")
+        seed_max_id = seed_history(db_path, args.concurrency, args.history, args.message_size)
+        env = dict(
+            os.environ,
+            OLLAMA_HOST=ollama_url,
+            OLLAMA_MODEL="load-test",
+            SESSION_BACKEND="sqlite",
+            SESSION_DB_PATH=db_path,
+        )
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "src.web.app:app",
+                "--host", "127.0.0.1",
+                "--port", str(port),
+                "--workers", str(workers),
+                "--log-level", "warning",
+            ],
+            cwd=ROOT_DIR,
+            env=env,
+        )
+        stop = threading.Event()
+        trimmer = threading.Thread(target=trim_history, args=(db_path, seed_max_id, stop))
+        try:
+            wait_until_ready(base_url)
+            trimmer.start()
+            ok, errors = run_load(base_url, args.concurrency, args.duration)
+        finally:
+            stop.set()
+            if trimmer.is_alive():
+                trimmer.join()
+            process.terminate()
+            process.wait(timeout=30)
+
+    throughput = ok / args.duration
+    print(f"workers={workers:<3} ok={ok:<6} errors={errors:<4} throughput={throughput:.1f} req/s")
+    return throughput
+
+
+def stream_ttft(base_url: str, message: str) -> float:
+    """/chat/stream に送信し、最初のトークンを受信するまでの秒数を返す（本文は最後まで読む）"""
+    body = urllib.parse.urlencode({"user_input": message}).encode("utf-8")
+    request = urllib.request.Request(f"{base_url}/chat/stream", data=body, method="POST")
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=120) as response:
+        # 先頭の start イベント（ストリームIDの通知）は読み飛ばす
+        for line in response:
+            if line.startswith(b"data:") and json.loads(line[5:]).get("type") in ("thinking", "response"):
+                break
+        ttft = time.perf_counter() - started
+        response.read()
+    return ttft
+
+
+def measure_ttft(ollama_url: str, args: argparse.Namespace) -> None:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(
+        os.environ,
+        OLLAMA_HOST=ollama_url,
+        OLLAMA_MODEL="load-test",
+        OLLAMA_PREFILL="1",
+        OLLAMA_PREFILL_INTERVAL="0",
+        SESSION_BACKEND="memory",
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "src.web.app:app",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--log-level", "warning",
+        ],
+        cwd=ROOT_DIR,
+        env=env,
+    )
+    samples = {True: [], False: []}
+    try:
+        wait_until_ready(base_url)
+        # 最初のターンは履歴が空のため、どちらの条件にも含めない
+        stream_ttft(base_url, "質問 0 " + "あ" * args.message_size)
+        for turn in range(1, args.turns + 1):
+            prefilled = turn % 2 == 0
+            if prefilled:
+                # 入力中に呼ばれる prefill を、送信前に完了させておく
+                request = urllib.request.Request(f"{base_url}/chat/prefill", data=b"", method="POST")
+                with urllib.request.urlopen(request, timeout=120) as response:
+                    status = json.loads(response.read())["status"]
+                if status != "done":
+                    print(f"warning: turn {turn} prefill status={status}")
+            samples[prefilled].append(stream_ttft(base_url, f"質問 {turn} " + "あ" * args.message_size))
+
+        with urllib.request.urlopen(f"{base_url}/chat/prefill/stats", timeout=10) as response:
+            server_stats = json.loads(response.read())
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    for prefilled, label in ((False, "without prefill"), (True, "with prefill")):
+        values = samples[prefilled]
+        average = sum(values) / len(values) * 1000 if values else float("nan")
+        print(f"{label:<16} turns={len(values):<3} client TTFT avg={average:.0f} ms")
+    print(f"server-side /chat/prefill/stats: {json.dumps(server_stats)}")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="ワーカー数ごとのスループット / prefill による TTFT の計測")
+    parser.add_argument("--mode", choices=["throughput", "ttft"], default="throughput", help="計測内容")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="計測するワーカー数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時リクエスト数")
+    parser.add_argument("--duration", type=float, default=10.0, help="1計測あたりの秒数")
+    parser.add_argument("--latency", type=float, default=0.0, help="疑似 Ollama の応答遅延（秒）")
+    parser.add_argument("--history", type=int, default=200, help="各クライアントのセッションにあらかじめ投入する履歴のメッセージ数")
+    parser.add_argument("--message-size", type=int, default=500, help="投入・送信する各メッセージの文字数")
+    parser.add_argument("--turns", type=int, default=20, help="ttft: 計測するターン数（prefill あり / なしを交互に送る）")
+    parser.add_argument("--eval-cost", type=float, default=0.0005, help="ttft: 疑似 Ollama の1文字あたりの評価時間（秒）")
+    parser.add_argument("--reply-size", type=int, default=400, help="ttft: 疑似 Ollama の思考過程・回答それぞれの文字数")
+    return parser
+
+
+def main() -> int:
+    args = build_arg_parser().parse_args()
+    if args.mode == "ttft":
+        server, ollama_url = start_prefix_cache_ollama(args.eval_cost, args.reply_size)
+        try:
+            measure_ttft(ollama_url, args)
+        finally:
+            server.shutdown()
+        return 0
+
+    cpus = available_cpus()
+    print(f"available CPUs: {cpus}")
+    if max(args.workers) > cpus:
+        print("warning: ワーカー数が CPU 数を超える計測は、CPU 処理が律速のためスループットが伸びません")
+    server, ollama_url = start_fake_ollama(args.latency)
+    try:
+        results: List[Tuple[int, float]] = []
+        for workers in args.workers:
+            results.append((workers, measure(workers, ollama_url, args)))
+    finally:
+        server.shutdown()
+
+    base_workers, base_throughput = results[0]
+    if base_throughput > 0:
+        for workers, throughput in results[1:]:
+            print(f"speedup {base_workers} -> {workers} workers: x{throughput / base_throughput:.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,21 +1,48 @@
+import uuid
 from typing import List, Dict, Optional, Any
 
+from src.core.session_backend import SessionBackend, MemorySessionBackend
+
+# 応答待ちのターンを記録する名前空間（キーはセッションID）
+TURN_NAMESPACE = "turns"
+# 応答が保存されないまま終わったターンに残すメッセージ
+INTERRUPTED_REPLY = "（応答は中断されました）"
+
 
 class ChatSession:
-    def __init__(self, system_prompt: Optional[str] = None) -> None:
-        self._messages: List[Dict[str, Any]] = []
-        if system_prompt:
-            self._messages.append({"role": "system", "content": system_prompt})
+    def __init__(
+        self,
+        system_prompt: Optional[str] = None,
+        backend: Optional[SessionBackend] = None,
+        session_id: str = "default",
+    ) -> None:
+        """
+        Args:
+            system_prompt: システムプロンプト（履歴が空の場合のみ追加）
+            backend: 履歴の保存先。省略時はプロセス内メモリに保持する
+            session_id: 保存先の中で会話を識別するID
+        """
+        self._backend = backend if backend is not None else MemorySessionBackend()
+        self.session_id = session_id
+        self._system_prompt = system_prompt
+        self._turns = self._backend.mapping(TURN_NAMESPACE)
+        if system_prompt and not self._backend.load_messages(session_id):
+            self._backend.append_message(session_id, {"role": "system", "content": system_prompt})
 
     @property
     def messages(self) -> List[Dict[str, Any]]:
-        return list(self._messages)
+        return self._backend.load_messages(self.session_id)
+
+    def clear(self) -> None:
+        """履歴を消去する（システムプロンプトは残す）"""
+        # 生成中の応答が消去後の履歴に書き込まれないよう、先にターンを終える
+        self._turns.pop(self.session_id, None)
+        self._backend.clear_messages(self.session_id)
+        if self._system_prompt:
+            self._backend.append_message(self.session_id, {"role": "system", "content": self._system_prompt})
 
     def add_user(self, content: str, images: Optional[List[Dict[str, str]]] = None) -> None:
-        message: Dict[str, Any] = {"role": "user", "content": content}
-        if images:
-            message["images"] = images
-        self._messages.append(message)
+        self._backend.append_message(self.session_id, self._user_message(content, images))
 
     def add_assistant(self, content: str, thinking: Optional[str] = None) -> None:
         """
@@ -25,10 +52,68 @@ class ChatSession:
             content: 最終回答テキスト
             thinking: 思考過程（thinkingモデル使用時のみ）
         """
+        self._backend.append_message(self.session_id, self._assistant_message(content, thinking))
+
+    def start_turn(self, content: str, images: Optional[List[Dict[str, str]]] = None) -> str:
+        """
+        ユーザーのメッセージを追加し、その応答を待つターンを開始する。
+        応答待ちのターンが残っていれば中断扱いにして、履歴の user / assistant の順序を保つ。
+        以前のターンの応答は、その後 finish_turn を呼んでも保存されない。
+
+        Returns:
+            ターンID（finish_turn / end_turn に渡す）
+        """
+        turn_id = uuid.uuid4().hex
+        user_message = self._user_message(content, images)
+        while True:
+            current = self._turns.get(self.session_id)
+            messages = [user_message]
+            if current is not None:
+                messages.insert(0, self._assistant_message(INTERRUPTED_REPLY))
+            # 他のワーカーが同時にターンを更新した場合は読み直してやり直す
+            if self._backend.replace_value(
+                TURN_NAMESPACE, self.session_id, current, turn_id, self.session_id, messages
+            ):
+                return turn_id
+
+    def is_current_turn(self, turn_id: str) -> bool:
+        """turn_id が応答待ちのターンか（中断・後続のメッセージで置き換えられていないか）"""
+        return self._turns.get(self.session_id) == turn_id
+
+    def finish_turn(self, turn_id: str, content: str, thinking: Optional[str] = None) -> bool:
+        """
+        turn_id が応答待ちのターンの場合に限り、アシスタントのメッセージを追加してターンを終える
+
+        Returns:
+            保存した場合は True、ターンがすでに終わっていた場合は False
+        """
+        return self._backend.replace_value(
+            TURN_NAMESPACE, self.session_id, turn_id, None, self.session_id,
+            [self._assistant_message(content, thinking)]
+        )
+
+    def end_turn(self, turn_id: str) -> bool:
+        """
+        応答を保存せずにターンを終える（停止操作など）
+
+        Returns:
+            終えた場合は True、ターンがすでに終わっていた場合は False
+        """
+        return self.finish_turn(turn_id, INTERRUPTED_REPLY)
+
+    @staticmethod
+    def _user_message(content: str, images: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+        message: Dict[str, Any] = {"role": "user", "content": content}
+        if images:
+            message["images"] = images
+        return message
+
+    @staticmethod
+    def _assistant_message(content: str, thinking: Optional[str] = None) -> Dict[str, Any]:
         message = {"role": "assistant", "content": content}
         if thinking:
             message["thinking"] = thinking
-        self._messages.append(message)
+        return message
 
     def ollama_messages(self, supports_images: bool = True) -> List[Dict[str, Any]]:
         """
@@ -40,7 +125,7 @@ class ChatSession:
                              Falseの場合は画像データを除外する。
         """
         normalized: List[Dict[str, Any]] = []
-        for message in self._messages:
+        for message in self._backend.load_messages(self.session_id):
             role = message.get("role")
             content = message.get("content", "")
             payload: Dict[str, Any] = {"role": role, "content": content}
@@ -1,7 +1,11 @@
+import http.client
 import logging
 import re
 import json
-from typing import List, Dict, Tuple, Optional, Generator, Any, Callable
+import socket
+import threading
+import urllib.parse
+from typing import List, Dict, Tuple, Optional, Generator, Any, Callable, MutableMapping
 
 import requests
 
@@ -14,6 +18,7 @@ class OllamaClient:
         timeout: float = 60.0,
         load_timeout: float | None = None,
         connect_timeout: float = 5.0,
+        capability_cache: Optional[MutableMapping[str, Optional[bool]]] = None,
     ) -> None:
         self.host = host.rstrip("/")
         self.model = model
@@ -22,7 +27,10 @@ class OllamaClient:
         self.connect_timeout = connect_timeout
         self._pending_model_load = False
         self._session = requests.Session()
-        self._image_support_cache: Dict[str, Optional[bool]] = {}
+        # 複数ワーカーで共有する場合は SessionBackend.mapping() などを渡す
+        self._image_support_cache: MutableMapping[str, Optional[bool]] = (
+            capability_cache if capability_cache is not None else {}
+        )
 
     def set_model(self, model: str) -> None:
         if model == self.model:
@@ -179,11 +187,18 @@ class OllamaClient:
     def chat_stream(
         self,
         messages: List[Dict[str, Any]],
-        should_stop: Optional[Callable[[], bool]] = None
+        should_stop: Optional[Callable[[], bool]] = None,
+        register_abort: Optional[Callable[[Callable[[], None]], None]] = None
     ) -> Generator[Dict[str, str], None, None]:
         """
         チャットをストリーミング実行してthinkingと回答を逐次返す
 
+        Args:
+            messages: 送信するメッセージ
+            should_stop: 受信した行ごとに呼ばれ、True を返すと打ち切る
+            register_abort: 中断用の関数を受け取るコールバック（別スレッドから呼び出してよい）。
+                            プロンプト評価中など、まだ行が届いていない間も接続を閉じて打ち切れる
+
         Yields:
             {"type": "thinking", "content": "..."} または
             {"type": "response", "content": "..."}
@@ -196,27 +211,17 @@ class OllamaClient:
         }
         logging.debug("POST %s payload=%s (streaming)", url, payload)
 
-        response: Optional[requests.Response] = None
+        aborted = threading.Event()
         try:
-            response = self._session.post(
-                url,
-                json=payload,
-                timeout=self._request_timeout(),
-                stream=True
-            )
-            response.raise_for_status()
-
-            if self._pending_model_load:
-                self._pending_model_load = False
-
             # ストリーミング状態の管理
             in_think_tag = False
             accumulated_buffer = ""
 
-            for line in response.iter_lines():
+            for line in self._stream_chat_lines(payload, aborted, register_abort):
                 if should_stop and should_stop():
                     logging.info("Streaming stopped by caller request.")
                     break
+                line = line.strip()
                 if not line:
                     continue
 
@@ -279,15 +284,112 @@ class OllamaClient:
                 else:
                     yield {"type": "response", "content": accumulated_buffer}
 
+            if aborted.is_set():
+                logging.info("Streaming aborted by caller request.")
+
         except requests.HTTPError as e:
             logging.error(f"HTTP Error: {e}")
             raise e
         except Exception as e:
             logging.error(f"Streaming error: {e}")
             raise e
+
+    def prefill(
+        self,
+        messages: List[Dict[str, Any]],
+        register_abort: Optional[Callable[[Callable[[], None]], None]] = None
+    ) -> bool:
+        """
+        履歴のプロンプト評価だけを行い、Ollama の KV キャッシュを温める
+
+        num_predict=0 は実装によって「上限なし」と解釈されるため、1トークンだけ生成させる。
+        register_abort に渡される関数を呼ぶと接続を閉じ、プロンプト評価中でも打ち切れる。
+
+        Args:
+            messages: 評価させる履歴
+            register_abort: 中断用の関数を受け取るコールバック（別スレッドから呼び出してよい）
+
+        Returns:
+            最後まで評価できた場合は True、中断された場合は False
+        """
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "stream": True,
+            "options": {"num_predict": 1},
+        }
+        logging.debug("POST %s/api/chat (prefill, %d messages)", self.host, len(messages))
+
+        aborted = threading.Event()
+        for line in self._stream_chat_lines(payload, aborted, register_abort):
+            try:
+                if json.loads(line).get("done"):
+                    break
+            except json.JSONDecodeError:
+                continue
+
+        return not aborted.is_set()
+
+    def _stream_chat_lines(
+        self,
+        payload: Dict[str, Any],
+        aborted: threading.Event,
+        register_abort: Optional[Callable[[Callable[[], None]], None]] = None
+    ) -> Generator[bytes, None, None]:
+        """
+        /api/chat にストリーミングで POST し、応答を1行ずつ返す
+
+        Ollama は最初のトークンが出るまで応答ヘッダーも返さないため、requests では
+        プロンプト評価中のリクエストを外から止められない。そこで http.client で接続を持ち、
+        register_abort に渡した関数が呼ばれたらソケットを閉じて Ollama 側の処理も打ち切らせる。
+        中断された場合は aborted をセットし、例外を送出せずに終了する。
+        """
+        parsed = urllib.parse.urlsplit(self.host)
+        connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        connect_timeout, read_timeout = self._request_timeout()
+        connection = connection_class(parsed.hostname, parsed.port, timeout=connect_timeout)
+
+        def abort() -> None:
+            aborted.set()
+            sock = connection.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        if register_abort is not None:
+            register_abort(abort)
+
+        path = f"{parsed.path.rstrip('/')}/api/chat"
+        body = json.dumps(payload).encode("utf-8")
+
+        try:
+            connection.connect()
+            # 接続中に中断された場合は、ソケットが割り当てられた後でここで検出する
+            if aborted.is_set():
+                return
+            connection.sock.settimeout(read_timeout)
+            connection.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            if response.status >= 400:
+                logging.error("Response content: %s", response.read().decode("utf-8", errors="replace"))
+                raise requests.HTTPError(f"{response.status} {response.reason} for url: {self.host}/api/chat")
+
+            if self._pending_model_load:
+                self._pending_model_load = False
+
+            while not aborted.is_set():
+                line = response.readline()
+                if not line:
+                    break
+                yield line
+        except (OSError, http.client.HTTPException):
+            if aborted.is_set():
+                return
+            raise
         finally:
-            if response is not None:
-                response.close()
+            connection.close()
 
     def list_models(self) -> List[str]:
         url = f"{self.host}/api/tags"
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from src.core.ollama_client import OllamaClient
+from src.core.session_backend import SessionBackend, MemorySessionBackend
+
+
+class PromptPrefiller:
+    """
+    入力中に会話履歴を先行評価（prefill）し、送信時の TTFT（最初のトークンまでの時間）を短縮する。
+
+    Ollama は直前のプロンプトと先頭が一致する部分の KV キャッシュを再利用するため、
+    送信前に履歴だけを評価させておけば、本番のリクエストでは新しいメッセージ分の評価で済む。
+
+    生成中かどうか・最後に prefill した履歴・最小間隔の基準時刻は backend に置くため、
+    共有できる backend を渡せば複数ワーカー間でも判定が揃う。
+    """
+
+    def __init__(
+        self,
+        min_interval: float = 3.0,
+        ttft_samples: int = 50,
+        backend: Optional[SessionBackend] = None,
+        generation_timeout: float = 600.0,
+    ) -> None:
+        """
+        Args:
+            min_interval: prefill を開始する最小間隔（秒）
+            ttft_samples: 平均に使う TTFT の直近サンプル数
+            backend: 状態の保存先。省略時はプロセス内メモリに保持する
+            generation_timeout: ワーカーが異常終了して残った生成中の記録を無視するまでの秒数
+        """
+        self.min_interval = min_interval
+        self.generation_timeout = generation_timeout
+        backend = backend if backend is not None else MemorySessionBackend()
+        self._state = backend.mapping("prefill")
+        # 生成ごとに開始時刻を記録する（キーを分けることでワーカー間の更新競合を避ける）
+        self._generations = backend.mapping("prefill_generations")
+        self._lock = threading.Lock()
+        self._cancel_event: Optional[threading.Event] = None
+        # 実行中の prefill の接続を閉じる関数（OllamaClient.prefill から登録される）
+        self._abort: Optional[Callable[[], None]] = None
+        self._ttft: Dict[bool, Deque[float]] = {
+            True: deque(maxlen=ttft_samples),
+            False: deque(maxlen=ttft_samples),
+        }
+
+    @staticmethod
+    def _signature(model: str, messages: List[Dict[str, Any]]) -> str:
+        raw = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def busy(self) -> bool:
+        """いずれかのワーカーで本番の生成が進行中か"""
+        now = time.time()
+        for generation_id in list(self._generations):
+            # 一覧取得後に他のワーカーが削除している場合があるため get で読む
+            started = self._generations.get(generation_id)
+            if started is not None and now - started < self.generation_timeout:
+                return True
+        return False
+
+    def prefill(self, client: OllamaClient, messages: List[Dict[str, Any]]) -> str:
+        """
+        履歴を prefill する。ブロッキングで実行されるためスレッドプールから呼び出すこと。
+
+        Returns:
+            実行結果の状態（"done", "cached", "busy", "rate_limited", "in_flight",
+            "cancelled", "empty", "error" のいずれか）
+        """
+        if not messages:
+            return "empty"
+
+        signature = self._signature(client.model, messages)
+        with self._lock:
+            # 生成中は Ollama の処理を奪わないよう何もしない
+            if self.busy:
+                return "busy"
+            if signature == self._state.get("last_signature"):
+                return "cached"
+            if self._cancel_event is not None:
+                return "in_flight"
+            now = time.time()
+            if now - self._state.get("last_started", 0.0) < self.min_interval:
+                return "rate_limited"
+            cancel_event = threading.Event()
+            self._cancel_event = cancel_event
+            self._state["last_started"] = now
+
+        def register_abort(abort: Callable[[], None]) -> None:
+            with self._lock:
+                self._abort = abort
+                cancelled = cancel_event.is_set()
+            # 登録前に中断が要求されていた場合はここで閉じる
+            if cancelled:
+                abort()
+
+        try:
+            completed = client.prefill(messages, register_abort=register_abort)
+        except Exception as e:
+            logging.warning("Prefill failed: %s", e)
+            return "error"
+        finally:
+            with self._lock:
+                if self._cancel_event is cancel_event:
+                    self._cancel_event = None
+                    self._abort = None
+
+        if not completed:
+            logging.debug("Prefill cancelled.")
+            return "cancelled"
+
+        self._state["last_signature"] = signature
+        logging.debug("Prefill completed for %d messages", len(messages))
+        return "done"
+
+    def cancel(self) -> None:
+        """
+        実行中の prefill があれば接続を閉じて中断する。
+        Ollama 側もクライアントの切断を検知してプロンプト評価を打ち切る。
+        """
+        with self._lock:
+            if self._cancel_event is None:
+                return
+            self._cancel_event.set()
+            abort = self._abort
+        if abort is not None:
+            abort()
+
+    @contextmanager
+    def generation(self) -> Iterator[None]:
+        """本番の生成中であることを記録し、その間の prefill を抑止・中断する"""
+        generation_id = uuid.uuid4().hex
+        self._generations[generation_id] = time.time()
+        self.cancel()
+        try:
+            yield
+        finally:
+            self._generations.pop(generation_id, None)
+
+    def is_prefilled(self, model: str, history: List[Dict[str, Any]]) -> bool:
+        """送信直前の履歴が prefill 済みのものと一致するか"""
+        return bool(history) and self._signature(model, history) == self._state.get("last_signature")
+
+    def record_ttft(self, seconds: float, prefilled: bool) -> None:
+        """TTFT を記録し、prefill の有無ごとの平均をログに出す"""
+        with self._lock:
+            self._ttft[prefilled].append(seconds)
+            stats = self.ttft_stats()
+        logging.info(
+            "TTFT %.0f ms (prefilled=%s) avg with prefill: %s, without: %s",
+            seconds * 1000,
+            prefilled,
+            _format_ms(stats["prefilled"]["avg_ms"]),
+            _format_ms(stats["cold"]["avg_ms"]),
+        )
+
+    def ttft_stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """prefill あり / なしそれぞれの直近サンプル数と平均 TTFT（ミリ秒）を返す"""
+        def summary(samples: Deque[float]) -> Dict[str, Optional[float]]:
+            return {
+                "count": len(samples),
+                "avg_ms": sum(samples) / len(samples) * 1000 if samples else None,
+            }
+
+        return {
+            "prefilled": summary(self._ttft[True]),
+            "cold": summary(self._ttft[False]),
+        }
+
+
+def _format_ms(milliseconds: Optional[float]) -> str:
+    return f"{milliseconds:.0f} ms" if milliseconds is not None else "-"
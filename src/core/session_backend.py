@@ -0,0 +1,348 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Iterator, List, MutableMapping, Optional, Sequence, Tuple
+
+
+class SessionBackend(ABC):
+    """
+    チャット履歴と共有設定（選択中のモデル、機能判定のキャッシュなど）、
+    再接続用のストリーミングイベントの保存先。
+    複数ワーカーで動かす場合はプロセス間で共有できる実装を使う。
+    """
+
+    @abstractmethod
+    def load_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def append_message(self, session_id: str, message: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def clear_messages(self, session_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def get_value(self, namespace: str, key: str) -> Any:
+        """値を返す。存在しない場合は KeyError を送出する"""
+
+    @abstractmethod
+    def set_value(self, namespace: str, key: str, value: Any) -> None:
+        ...
+
+    @abstractmethod
+    def delete_value(self, namespace: str, key: str) -> None:
+        """値を削除する。存在しない場合は KeyError を送出する"""
+
+    @abstractmethod
+    def keys(self, namespace: str) -> List[str]:
+        ...
+
+    @abstractmethod
+    def replace_value(
+        self,
+        namespace: str,
+        key: str,
+        expected: Any,
+        value: Any,
+        session_id: Optional[str] = None,
+        messages: Sequence[Dict[str, Any]] = (),
+    ) -> bool:
+        """
+        値が expected（None は未設定）の場合に限り value（None は削除）に置き換え、
+        あわせて session_id の履歴に messages を追記する。判定と書き込みは不可分に行う。
+
+        Returns:
+            置き換えた場合は True、値が expected と異なり何もしなかった場合は False
+        """
+
+    @abstractmethod
+    def append_event(self, stream_id: str, seq: int, data: str) -> None:
+        ...
+
+    @abstractmethod
+    def load_events(self, stream_id: str, after_seq: int = 0) -> List[Tuple[int, str]]:
+        """after_seq より後のイベントを連番順に返す"""
+
+    @abstractmethod
+    def delete_events(self, stream_id: str, up_to_seq: Optional[int] = None) -> None:
+        """up_to_seq 以前（省略時はすべて）のイベントを削除する"""
+
+    def mapping(self, namespace: str) -> "BackendMapping":
+        """名前空間を dict のように扱うためのラッパーを返す"""
+        return BackendMapping(self, namespace)
+
+
+class BackendMapping(MutableMapping[str, Any]):
+    """SessionBackend の1つの名前空間を MutableMapping として公開する"""
+
+    def __init__(self, backend: SessionBackend, namespace: str) -> None:
+        self.backend = backend
+        self.namespace = namespace
+
+    def __getitem__(self, key: str) -> Any:
+        return self.backend.get_value(self.namespace, key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.backend.set_value(self.namespace, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self.backend.delete_value(self.namespace, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.backend.keys(self.namespace))
+
+    def __len__(self) -> int:
+        return len(self.backend.keys(self.namespace))
+
+
+class MemorySessionBackend(SessionBackend):
+    """プロセス内のみで保持する実装（単一プロセス・CLI 用の既定）"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._messages: Dict[str, List[Dict[str, Any]]] = {}
+        self._values: Dict[str, Dict[str, Any]] = {}
+        self._events: Dict[str, List[Tuple[int, str]]] = {}
+
+    def load_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._messages.get(session_id, []))
+
+    def append_message(self, session_id: str, message: Dict[str, Any]) -> None:
+        with self._lock:
+            self._messages.setdefault(session_id, []).append(message)
+
+    def clear_messages(self, session_id: str) -> None:
+        with self._lock:
+            self._messages.pop(session_id, None)
+
+    def get_value(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            return self._values.get(namespace, {})[key]
+
+    def set_value(self, namespace: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._values.setdefault(namespace, {})[key] = value
+
+    def delete_value(self, namespace: str, key: str) -> None:
+        with self._lock:
+            del self._values.get(namespace, {})[key]
+
+    def keys(self, namespace: str) -> List[str]:
+        with self._lock:
+            return list(self._values.get(namespace, {}))
+
+    def replace_value(
+        self,
+        namespace: str,
+        key: str,
+        expected: Any,
+        value: Any,
+        session_id: Optional[str] = None,
+        messages: Sequence[Dict[str, Any]] = (),
+    ) -> bool:
+        with self._lock:
+            values = self._values.setdefault(namespace, {})
+            if values.get(key) != expected:
+                return False
+            if value is None:
+                values.pop(key, None)
+            else:
+                values[key] = value
+            if messages:
+                self._messages.setdefault(session_id, []).extend(messages)
+            return True
+
+    def append_event(self, stream_id: str, seq: int, data: str) -> None:
+        with self._lock:
+            self._events.setdefault(stream_id, []).append((seq, data))
+
+    def load_events(self, stream_id: str, after_seq: int = 0) -> List[Tuple[int, str]]:
+        with self._lock:
+            return [event for event in self._events.get(stream_id, []) if event[0] > after_seq]
+
+    def delete_events(self, stream_id: str, up_to_seq: Optional[int] = None) -> None:
+        with self._lock:
+            if up_to_seq is None:
+                self._events.pop(stream_id, None)
+            elif stream_id in self._events:
+                self._events[stream_id] = [event for event in self._events[stream_id] if event[0] > up_to_seq]
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    SQLite ファイルに保存する実装。同一ホスト上の複数ワーカープロセスで共有できる。
+    WAL モードで読み書きを並行させ、書き込みの競合は busy_timeout で待機する。
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 5.0) -> None:
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " data TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stream_events ("
+                " stream_id TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " data TEXT NOT NULL,"
+                " PRIMARY KEY (stream_id, seq))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッドをまたいで使えないため、スレッドごとに保持する
+        conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def load_messages(self, session_id: str) -> List[Dict[str, Any]]:
+        rows = self._connection().execute(
+            "SELECT data FROM messages WHERE session_id = ? ORDER BY id",
+            (session_id,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append_message(self, session_id: str, message: Dict[str, Any]) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO messages (session_id, data) VALUES (?, ?)",
+                (session_id, json.dumps(message, ensure_ascii=False))
+            )
+
+    def clear_messages(self, session_id: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    def get_value(self, namespace: str, key: str) -> Any:
+        row = self._connection().execute(
+            "SELECT value FROM kv WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def set_value(self, namespace: str, key: str, value: Any) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False))
+            )
+
+    def delete_value(self, namespace: str, key: str) -> None:
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def keys(self, namespace: str) -> List[str]:
+        rows = self._connection().execute(
+            "SELECT key FROM kv WHERE namespace = ? ORDER BY key",
+            (namespace,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def replace_value(
+        self,
+        namespace: str,
+        key: str,
+        expected: Any,
+        value: Any,
+        session_id: Optional[str] = None,
+        messages: Sequence[Dict[str, Any]] = (),
+    ) -> bool:
+        conn = self._connection()
+        with conn:
+            # 読み取りの時点で書き込みロックを取り、他のワーカーとの競合を防ぐ
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value FROM kv WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            current = json.loads(row[0]) if row is not None else None
+            if current != expected:
+                return False
+            if value is None:
+                conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)",
+                    (namespace, key, json.dumps(value, ensure_ascii=False))
+                )
+            conn.executemany(
+                "INSERT INTO messages (session_id, data) VALUES (?, ?)",
+                [(session_id, json.dumps(message, ensure_ascii=False)) for message in messages]
+            )
+        return True
+
+    def append_event(self, stream_id: str, seq: int, data: str) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stream_events (stream_id, seq, data) VALUES (?, ?, ?)",
+                (stream_id, seq, data)
+            )
+
+    def load_events(self, stream_id: str, after_seq: int = 0) -> List[Tuple[int, str]]:
+        rows = self._connection().execute(
+            "SELECT seq, data FROM stream_events WHERE stream_id = ? AND seq > ? ORDER BY seq",
+            (stream_id, after_seq)
+        ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def delete_events(self, stream_id: str, up_to_seq: Optional[int] = None) -> None:
+        conn = self._connection()
+        with conn:
+            if up_to_seq is None:
+                conn.execute("DELETE FROM stream_events WHERE stream_id = ?", (stream_id,))
+            else:
+                conn.execute(
+                    "DELETE FROM stream_events WHERE stream_id = ? AND seq <= ?",
+                    (stream_id, up_to_seq)
+                )
+
+
+def create_session_backend(kind: str, path: Optional[str] = None) -> SessionBackend:
+    """
+    設定値から保存先を生成する
+
+    Args:
+        kind: "memory" または "sqlite"
+        path: sqlite の場合のデータベースファイルのパス
+    """
+    kind = kind.lower()
+    if kind == "memory":
+        return MemorySessionBackend()
+    if kind == "sqlite":
+        return SQLiteSessionBackend(path or "ollama_chat_sessions.sqlite3")
+    raise ValueError(f"未対応のセッションバックエンドです: {kind}")
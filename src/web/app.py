@@ -1,39 +1,100 @@
 import os
+import re
+import asyncio
+import atexit
 import logging
 import json
 import base64
+import time
 from typing import Annotated, List, Optional, Dict
 
-from fastapi import FastAPI, Request, Form, Depends, UploadFile, File
+from fastapi import FastAPI, Request, Form, Depends, UploadFile, File, Header
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool, iterate_in_threadpool
 
 from src.core.ollama_client import OllamaClient
 from src.core.chat_session import ChatSession
+from src.core.prefill import PromptPrefiller
+from src.core.session_backend import create_session_backend
+from src.web.assets import StaticAssets, PrecompressedStaticFiles, HTMLCompressionMiddleware
+from src.web.streams import GenerationStream, StreamRegistry
 
 app = FastAPI(title="Ollama Chat UI")
 
-# 静的ファイルのマウント
-app.mount("/static", StaticFiles(directory="src/web/static"), name="static")
+# 静的ファイルを起動時に事前圧縮し、コンテンツハッシュ付き URL で配信する
+static_assets = StaticAssets("src/web/static", output_dir=os.getenv("STATIC_BUILD_DIR"))
+static_assets.build()
+atexit.register(static_assets.cleanup)
+app.mount("/static", PrecompressedStaticFiles(static_assets), name="static")
+
+# HTML 応答（チャット履歴のパーシャル）を圧縮する。SSE は逐次送信のため対象外
+app.add_middleware(HTMLCompressionMiddleware)
 
 # テンプレートエンジンの設定
 templates = Jinja2Templates(directory="src/web/templates")
+templates.env.globals["static_url"] = static_assets.url
+
+# SSE をプロキシや圧縮でバッファリングさせないためのヘッダー
+SSE_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "X-Accel-Buffering": "no",
+}
+
+# セッションの保存先（uvicorn --workers N で動かす場合は sqlite を指定してワーカー間で共有する）
+session_backend = create_session_backend(
+    os.getenv("SESSION_BACKEND", "memory"),
+    os.getenv("SESSION_DB_PATH")
+)
+# 選択中のモデルなど、ワーカー間で共有する設定
+shared_settings = session_backend.mapping("settings")
 
 # グローバルセッション（簡易実装）
 session_store = {
-    "chat_session": ChatSession(),
+    "chat_session": ChatSession(backend=session_backend),
     "ollama_client": OllamaClient(
         host=os.getenv("OLLAMA_HOST", "http://localhost:11434"),
-        model=os.getenv("OLLAMA_MODEL", "gemma3")
+        model=os.getenv("OLLAMA_MODEL", "gemma3"),
+        capability_cache=session_backend.mapping("image_support")
     )
 }
 
-def get_chat_session():
-    return session_store["chat_session"]
+# 入力中の履歴 prefill（オプトイン）
+PREFILL_ENABLED = os.getenv("OLLAMA_PREFILL", "0") == "1"
+prefiller = PromptPrefiller(
+    min_interval=float(os.getenv("OLLAMA_PREFILL_INTERVAL", "3.0")),
+    backend=session_backend
+)
+# prefill 中にクライアントの切断を確認する間隔（秒）
+PREFILL_POLL_INTERVAL = 0.2
+
+# 停止操作や後続のメッセージで生成を打ち切った場合に送るイベント
+INTERRUPTED_EVENT = {"type": "error", "content": "応答は中断されました。"}
+
+# 再接続（Last-Event-ID）用に生成中のイベントを保持する
+stream_registry = StreamRegistry(
+    session_backend,
+    buffer_size=int(os.getenv("STREAM_BUFFER_SIZE", "1024")),
+    grace_period=float(os.getenv("STREAM_GRACE_PERIOD", "30.0"))
+)
+
+# クッキーでセッションIDを指定すると別の会話として扱う（未指定時は共通の会話）
+SESSION_COOKIE = "chat_session_id"
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+def get_chat_session(request: Request):
+    session_id = request.cookies.get(SESSION_COOKIE, "")
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        return session_store["chat_session"]
+    return ChatSession(backend=session_backend, session_id=session_id)
 
 def get_ollama_client():
-    return session_store["ollama_client"]
+    client = session_store["ollama_client"]
+    # 他のワーカーで変更されたモデル選択を反映する
+    model = shared_settings.get("model")
+    if model and model != client.model:
+        client.set_model(model)
+    return client
 
 async def encode_images(files: Optional[List[UploadFile]]) -> List[Dict[str, str]]:
     if not files:
@@ -72,18 +133,20 @@ async def read_root(
         # 最初のモデルを自動選択する
         if ollama_client.model not in models:
             ollama_client.model = models[0]
+            shared_settings["model"] = ollama_client.model
             logging.info(f"Default model auto-switched to: {ollama_client.model}")
     else:
         # 一覧が取れなかった場合は現在の設定を維持して表示だけする
         models = [ollama_client.model]
 
     return templates.TemplateResponse(
+        request,
         "index.html",
         {
-            "request": request,
             "messages": [],
             "current_model": ollama_client.model,
-            "models": models
+            "models": models,
+            "prefill_enabled": PREFILL_ENABLED
         }
     )
 
@@ -101,8 +164,9 @@ async def chat(
         reply = f"エラー: {exc}"
         chat_session.add_assistant(reply)
         return templates.TemplateResponse(
+            request,
             "partials/chat_history.html",
-            {"request": request, "messages": chat_session.messages}
+            {"messages": chat_session.messages}
         )
     if not user_input or not user_input.strip():
         if not image_payloads:
@@ -115,21 +179,23 @@ async def chat(
             reply = f"エラー: 現在のモデル「{ollama_client.model}」は画像入力に対応していません。"
             chat_session.add_assistant(reply)
             return templates.TemplateResponse(
+                request,
                 "partials/chat_history.html",
-                {"request": request, "messages": chat_session.messages}
+                {"messages": chat_session.messages}
             )
 
-    chat_session.add_user(user_input, images=image_payloads if image_payloads else None)
+    turn_id = chat_session.start_turn(user_input, images=image_payloads if image_payloads else None)
 
     try:
         # 現在のモデルが画像をサポートするかどうかを確認
         supports_images = ollama_client.supports_images()
         # Ollama API を使用（thinking自動抽出）
-        thinking, reply = ollama_client.chat(
-            chat_session.ollama_messages(supports_images=supports_images if supports_images is not None else True),
-            stream=False
-        )
-        chat_session.add_assistant(reply, thinking=thinking)
+        with prefiller.generation():
+            thinking, reply = ollama_client.chat(
+                chat_session.ollama_messages(supports_images=supports_images if supports_images is not None else True),
+                stream=False
+            )
+        chat_session.finish_turn(turn_id, reply, thinking=thinking)
 
         if thinking:
             logging.debug(f"Thinking extracted - thinking: {len(thinking)} chars, reply: {len(reply)} chars")
@@ -139,11 +205,12 @@ async def chat(
     except Exception as e:
         logging.error(f"Error communicating with Ollama: {e}")
         reply = f"エラーが発生しました: {e}"
-        chat_session.add_assistant(reply)
+        chat_session.finish_turn(turn_id, reply)
 
     return templates.TemplateResponse(
+        request,
         "partials/chat_history.html",
-        {"request": request, "messages": chat_session.messages}
+        {"messages": chat_session.messages}
     )
 
 @app.post("/chat/stream")
@@ -167,10 +234,10 @@ async def chat_stream(
             }, ensure_ascii=False)
             yield f"data: {error_event}\n\n"
 
-        return StreamingResponse(error_generator(), media_type="text/event-stream")
+        return StreamingResponse(error_generator(), media_type="text/event-stream", headers=SSE_HEADERS)
     if not user_input or not user_input.strip():
         if not image_payloads:
-            return StreamingResponse(iter([]), media_type="text/event-stream")
+            return StreamingResponse(iter([]), media_type="text/event-stream", headers=SSE_HEADERS)
         user_input = ""
 
     if image_payloads:
@@ -183,71 +250,195 @@ async def chat_stream(
                 }, ensure_ascii=False)
                 yield f"data: {error_event}\n\n"
 
-            return StreamingResponse(error_generator(), media_type="text/event-stream")
-
-    chat_session.add_user(user_input, images=image_payloads if image_payloads else None)
+            return StreamingResponse(error_generator(), media_type="text/event-stream", headers=SSE_HEADERS)
 
-    async def event_generator():
-        try:
-            thinking_buffer = []
-            response_buffer = []
-            disconnected = False
-            # 現在のモデルが画像をサポートするかどうかを確認
-            supports_images = ollama_client.supports_images()
+    # 応答待ちの前のターンがあれば中断扱いになり、その生成は次の確認で停止する
+    turn_id = await run_in_threadpool(
+        chat_session.start_turn, user_input, images=image_payloads if image_payloads else None
+    )
 
-            for chunk in ollama_client.chat_stream(
-                chat_session.ollama_messages(supports_images=supports_images if supports_images is not None else True),
-                should_stop=lambda: disconnected
-            ):
-                if await request.is_disconnected():
-                    disconnected = True
-                    logging.info("Client disconnected. Stopping streaming.")
-                    break
+    # 生成はクライアントの接続とは独立したタスクで行い、イベントはセッションの保存先に残す
+    stream = await stream_registry.create(turn_id, is_current=lambda: chat_session.is_current_turn(turn_id))
+    # 最初のトークンより前に停止・再接続できるよう、ストリームIDを最初のイベントで通知する
+    await stream.publish({"type": "start"})
+    stream.task = asyncio.create_task(run_generation(stream, chat_session, ollama_client))
 
-                chunk_type = chunk.get("type")
-                content = chunk.get("content", "")
+    return StreamingResponse(
+        stream_registry.subscribe(stream.stream_id), media_type="text/event-stream", headers=SSE_HEADERS
+    )
 
-                if chunk_type == "thinking":
-                    thinking_buffer.append(content)
-                elif chunk_type == "response":
-                    response_buffer.append(content)
+async def run_generation(
+    stream: GenerationStream,
+    chat_session: ChatSession,
+    ollama_client: OllamaClient
+) -> None:
+    """
+    Ollama からの応答を GenerationStream に書き込む。
+    クライアントが切断しても猶予期間内は生成を続け、完了すればセッションに保存する。
+    停止操作や後続のメッセージでターンが終わっていた場合は保存しない。
+    セッションの保存先の読み書きはスレッドプールで行う（SQLite の書き込み待ちでループを塞がないため）。
+    """
+    with prefiller.generation():
+        chunks = None
+        watcher = asyncio.create_task(stream.watch())
+        try:
+            def load_messages():
+                # 現在のモデルが画像をサポートするかどうかを確認
+                supports_images = ollama_client.supports_images()
+                messages = chat_session.ollama_messages(supports_images=supports_images if supports_images is not None else True)
+                # TTFT 計測（送信直前の履歴が prefill 済みだったかで分けて記録する）
+                return messages, prefiller.is_prefilled(ollama_client.model, messages[:-1])
+
+            messages, prefilled = await run_in_threadpool(load_messages)
+            started_at = time.perf_counter()
+            first_chunk = True
+
+            chunks = ollama_client.chat_stream(
+                messages, should_stop=stream.abandoned, register_abort=stream.register_abort
+            )
+            # 同期のジェネレーターはスレッドプールで回し、イベントループを塞がない
+            async for chunk in iterate_in_threadpool(chunks):
+                if first_chunk:
+                    prefiller.record_ttft(time.perf_counter() - started_at, prefilled)
+                    first_chunk = False
+
+                # 保存先の確認はスレッド側の should_stop で行い、ここではフラグだけ見る
+                if stream.cancelled:
+                    break
 
-                # SSE形式でデータを送信
-                event_data = json.dumps(chunk, ensure_ascii=False)
-                yield f"data: {event_data}\n\n"
+                await stream.publish(chunk)
 
-            if disconnected:
+            if await run_in_threadpool(stream.abandoned):
+                logging.info("Stream %s abandoned. Stopping generation.", stream.stream_id)
+                await run_in_threadpool(chat_session.end_turn, stream.stream_id)
+                await stream.publish(INTERRUPTED_EVENT)
                 return
 
-            # ストリーミング完了後、セッションに保存
-            thinking_text = "".join(thinking_buffer) if thinking_buffer else None
-            response_text = "".join(response_buffer)
+            # ストリーミング完了後、ターンが続いていればセッションに保存
+            thinking_text = "".join(stream.thinking) if stream.thinking else None
+            response_text = "".join(stream.response)
 
-            chat_session.add_assistant(response_text, thinking=thinking_text)
+            saved = await run_in_threadpool(
+                chat_session.finish_turn, stream.stream_id, response_text, thinking=thinking_text
+            )
+            if not saved:
+                logging.info("Stream %s was superseded. Discarding the response.", stream.stream_id)
+                await stream.publish(INTERRUPTED_EVENT)
+                return
 
             # 完了イベントを送信
-            yield f"data: {json.dumps({'type': 'done'}, ensure_ascii=False)}\n\n"
+            await stream.publish({"type": "done"})
 
             logging.debug(f"Streaming completed - thinking: {len(thinking_text) if thinking_text else 0} chars, response: {len(response_text)} chars")
 
         except Exception as e:
             logging.error(f"Error during streaming: {e}")
-            error_event = json.dumps({
+            await run_in_threadpool(chat_session.finish_turn, stream.stream_id, f"エラーが発生しました: {str(e)}")
+            await stream.publish({
                 "type": "error",
                 "content": f"エラーが発生しました: {str(e)}"
+            })
+        finally:
+            watcher.cancel()
+            if chunks is not None:
+                try:
+                    chunks.close()
+                except ValueError:
+                    # タスクのキャンセル時はスレッド側でまだ実行中の場合がある
+                    pass
+            await stream.finish()
+            stream_registry.discard_later(stream)
+
+@app.get("/chat/stream/resume")
+async def chat_stream_resume(
+    last_event_id: Annotated[Optional[str], Header()] = None
+):
+    """
+    Last-Event-ID 以降のイベントを再送し、生成中であれば続きを配信する。
+    イベントはセッションの保存先から読むため、生成中のワーカー以外に振り分けられても再開できる。
+    """
+    parsed = StreamRegistry.parse_event_id(last_event_id)
+    if parsed is None or not await stream_registry.exists(parsed[0]):
+        async def error_generator():
+            error_event = json.dumps({
+                "type": "error",
+                "content": "エラー: 再接続先のストリームが見つかりません（期限切れの可能性があります）。"
             }, ensure_ascii=False)
             yield f"data: {error_event}\n\n"
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+        return StreamingResponse(error_generator(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    return StreamingResponse(
+        stream_registry.subscribe(*parsed), media_type="text/event-stream", headers=SSE_HEADERS
+    )
+
+@app.post("/chat/stream/cancel")
+async def chat_stream_cancel(
+    stream_id: Annotated[str, Form()],
+    chat_session: ChatSession = Depends(get_chat_session)
+):
+    """
+    ユーザーの停止操作で生成を中断する（切断だけでは猶予期間中は生成を続けるため）。
+    ターンの終了はセッションの保存先に記録され、生成中のワーカーが次の確認で停止する。
+    """
+    stream = stream_registry.get(stream_id)
+    if stream is not None:
+        # このワーカーで生成中であれば、保存先の確認を待たずに止める
+        stream.cancel()
+    # 停止済み・完了済みのストリームに対しては何もしない（複数回呼ばれてもよい）
+    ended = await run_in_threadpool(chat_session.end_turn, stream_id)
+    if not ended and not await stream_registry.exists(stream_id):
+        return JSONResponse({"status": "not_found"}, status_code=404)
+    return JSONResponse({"status": "cancelled"})
+
+@app.post("/chat/prefill")
+async def chat_prefill(
+    request: Request,
+    chat_session: ChatSession = Depends(get_chat_session),
+    ollama_client: OllamaClient = Depends(get_ollama_client)
+):
+    """
+    入力中に呼ばれ、現在の履歴を先に評価させておく（送信時の TTFT 短縮用）。
+    ブラウザが fetch を中断した場合は、Ollama への prefill も中断する。
+    """
+    if not PREFILL_ENABLED:
+        return JSONResponse({"status": "disabled"}, status_code=404)
+    if prefiller.busy:
+        return JSONResponse({"status": "busy"})
+
+    supports_images = ollama_client.supports_images()
+    messages = chat_session.ollama_messages(supports_images=supports_images if supports_images is not None else True)
+    task = asyncio.ensure_future(run_in_threadpool(prefiller.prefill, ollama_client, messages))
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=PREFILL_POLL_INTERVAL)
+        if done:
+            break
+        if await request.is_disconnected():
+            logging.debug("Prefill request disconnected. Cancelling prefill.")
+            prefiller.cancel()
+            break
+        # 他のワーカーで生成が始まった場合も、Ollama を空けるため中断する
+        if prefiller.busy:
+            logging.debug("Generation started on another worker. Cancelling prefill.")
+            prefiller.cancel()
+            break
+    status = await task
+    return JSONResponse({"status": status})
+
+@app.get("/chat/prefill/stats")
+async def chat_prefill_stats():
+    """prefill あり / なしの TTFT 統計（このワーカーで計測した分）を返す"""
+    return JSONResponse(prefiller.ttft_stats())
 
 @app.post("/set_model", response_class=HTMLResponse)
 async def set_model(
     request: Request,
-    model_name: Annotated[str, Form()]
+    model_name: Annotated[str, Form()],
+    client: OllamaClient = Depends(get_ollama_client)
 ):
     """モデルを変更する"""
-    client = session_store["ollama_client"]
     client.set_model(model_name)
+    shared_settings["model"] = model_name
     logging.info(f"Model changed to {model_name}")
 
     # モデル変更時はチャット履歴をリセットするか、継続するか選べるが、
@@ -256,9 +447,13 @@ async def set_model(
     return HTMLResponse(model_name)
 
 @app.get("/reset", response_class=HTMLResponse)
-async def reset_chat(request: Request):
-    session_store["chat_session"] = ChatSession()
+async def reset_chat(
+    request: Request,
+    chat_session: ChatSession = Depends(get_chat_session)
+):
+    chat_session.clear()
     return templates.TemplateResponse(
-        "partials/chat_history.html", 
-        {"request": request, "messages": []}
+        request,
+        "partials/chat_history.html",
+        {"messages": []}
     )
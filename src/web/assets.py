@@ -0,0 +1,251 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Set, Tuple
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, PathLike, StaticFiles
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli は任意依存。未インストール時は gzip のみ生成する
+    brotli = None
+
+
+# 事前圧縮の対象とするテキスト系アセット
+COMPRESSIBLE_SUFFIXES = (".css", ".js", ".svg", ".html", ".json", ".txt", ".map")
+
+# コンテンツハッシュ付き URL はファイル内容が変われば URL も変わるため、永続キャッシュしてよい
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# ハッシュなしの URL は更新を取りこぼさないよう毎回再検証させる
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Accept-Encoding の優先順（先にあるものほど圧縮率が高い）
+ENCODINGS: Tuple[Tuple[str, str], ...] = (("br", ".br"), ("gzip", ".gz"))
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Accept-Encoding をコーディングごとの q 値に分解する（"gzip;q=0" などの拒否も保持する）"""
+    qvalues: Dict[str, float] = {}
+    for part in header.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    return qvalues
+
+
+def choose_encodings(header: str) -> List[str]:
+    """
+    受け入れ可能（q > 0）なコーディングを優先順に返す。
+    q 値の高い順、同じ q 値なら ENCODINGS の順（圧縮率の高い順）とする。
+    """
+    qvalues = parse_accept_encoding(header)
+    wildcard = qvalues.get("*", 0.0)
+    candidates = []
+    for index, (encoding, _) in enumerate(ENCODINGS):
+        q = qvalues.get(encoding, wildcard)
+        if q > 0:
+            candidates.append((-q, index, encoding))
+    return [encoding for _, _, encoding in sorted(candidates)]
+
+
+class StaticAssets:
+    """
+    起動時に静的ファイルをビルド用ディレクトリへコピーし、
+    コンテンツハッシュ付きのファイル名と gzip / brotli の事前圧縮版を生成する。
+
+    ビルド用ディレクトリはワーカーや再起動のたびに変わりうるため、ETag は
+    ファイル内容のハッシュから作り、更新日時は元ファイルのものを引き継ぐ。
+    """
+
+    def __init__(self, source_dir: str, output_dir: Optional[str] = None, hash_length: int = 12) -> None:
+        self.source_dir = source_dir
+        # 出力先が指定されない場合は一時ディレクトリを作り、終了時に削除する
+        self._owns_output_dir = output_dir is None
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix="ollama_chat_static_")
+        self.hash_length = hash_length
+        self.manifest: Dict[str, str] = {}
+        self._hashed_paths: Set[str] = set()
+        # ビルド用ディレクトリ内の相対パス（圧縮版を含む）ごとの ETag
+        self._etags: Dict[str, str] = {}
+
+    def build(self) -> Dict[str, str]:
+        """
+        静的ファイルを走査してビルド用ディレクトリを作り直す。
+
+        Returns:
+            元の相対パスからハッシュ付き相対パスへの対応表
+        """
+        manifest: Dict[str, str] = {}
+        self._etags = {}
+        for root, _, files in os.walk(self.source_dir):
+            for filename in files:
+                source_path = os.path.join(root, filename)
+                rel_path = os.path.relpath(source_path, self.source_dir).replace(os.sep, "/")
+
+                with open(source_path, "rb") as f:
+                    data = f.read()
+
+                digest = hashlib.sha256(data).hexdigest()[: self.hash_length]
+                stem, suffix = os.path.splitext(rel_path)
+                hashed_path = f"{stem}.{digest}{suffix}"
+                mtime = os.stat(source_path).st_mtime
+
+                # ハッシュなしの URL でも引き続き配信できるよう、元の名前でも置いておく
+                self._write(rel_path, data, digest, mtime)
+                self._write(hashed_path, data, digest, mtime)
+                manifest[rel_path] = hashed_path
+
+        self.manifest = manifest
+        self._hashed_paths = set(manifest.values())
+        logging.info("Static assets built: %d files -> %s", len(manifest), self.output_dir)
+        return manifest
+
+    def _write(self, rel_path: str, data: bytes, digest: str, mtime: float) -> None:
+        target = os.path.join(self.output_dir, *rel_path.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        self._atomic_write(target, data, mtime)
+        self._etags[rel_path] = f'"{digest}"'
+
+        if not rel_path.lower().endswith(COMPRESSIBLE_SUFFIXES):
+            return
+
+        variants = [(".gz", gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append((".br", brotli.compress(data)))
+
+        for suffix, compressed in variants:
+            # 圧縮しても小さくならない場合は生成しない
+            if len(compressed) < len(data):
+                self._atomic_write(target + suffix, compressed, mtime)
+                # 圧縮版は別の表現のため、元ファイルとは異なる ETag にする
+                self._etags[rel_path + suffix] = f'"{digest}-{suffix[1:]}"'
+
+    @staticmethod
+    def _atomic_write(target: str, data: bytes, mtime: float) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.utime(tmp_path, (mtime, mtime))
+            os.replace(tmp_path, target)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def url(self, path: str) -> str:
+        """テンプレート用: 元の相対パスからハッシュ付き URL を返す"""
+        rel_path = path.lstrip("/")
+        return f"/static/{self.manifest.get(rel_path, rel_path)}"
+
+    def is_hashed(self, rel_path: str) -> bool:
+        return rel_path in self._hashed_paths
+
+    def etag(self, rel_path: str) -> Optional[str]:
+        """ビルド用ディレクトリ内の相対パスに対する、内容から求めた ETag を返す"""
+        return self._etags.get(rel_path)
+
+    def cleanup(self) -> None:
+        if not self._owns_output_dir:
+            return
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Accept-Encoding に応じて事前圧縮版（.br / .gz）を返す StaticFiles。
+    ハッシュ付きのパスには immutable なキャッシュヘッダーを付与する。
+    """
+
+    def __init__(self, assets: StaticAssets, **kwargs) -> None:
+        super().__init__(directory=assets.output_dir, **kwargs)
+        self.assets = assets
+
+    def file_response(
+        self,
+        full_path: PathLike,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        # ワーカー間・再起動後も同じ内容には同じ ETag を返し、再検証を成立させる
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+        etag = self.assets.etag(rel_path)
+        if etag is not None:
+            response.headers["etag"] = etag
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        rel_path = path.replace(os.sep, "/")
+        accepted = choose_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        suffixes = dict(ENCODINGS)
+
+        response: Optional[Response] = None
+        if rel_path.lower().endswith(COMPRESSIBLE_SUFFIXES):
+            for encoding in accepted:
+                suffix = suffixes[encoding]
+                variant = os.path.join(self.directory, path + suffix)
+                if not os.path.isfile(variant):
+                    continue
+                response = await super().get_response(path + suffix, scope)
+                media_type, _ = mimetypes.guess_type(rel_path)
+                if media_type:
+                    if media_type.startswith("text/") or media_type.endswith("javascript"):
+                        media_type += "; charset=utf-8"
+                    response.headers["content-type"] = media_type
+                response.headers["content-encoding"] = encoding
+                break
+
+        if response is None:
+            response = await super().get_response(path, scope)
+
+        if rel_path.lower().endswith(COMPRESSIBLE_SUFFIXES):
+            response.headers["vary"] = "Accept-Encoding"
+        if self.assets.is_hashed(rel_path):
+            response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["cache-control"] = REVALIDATE_CACHE_CONTROL
+        return response
+
+
+class HTMLCompressionMiddleware:
+    """
+    HTML 応答（チャット履歴のパーシャルなど）を gzip 圧縮するミドルウェア。
+    事前圧縮済みの静的ファイルと、逐次送信が必要な SSE のパスは素通しする。
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        exclude_paths: Tuple[str, ...] = ("/static", "/chat/stream"),
+        minimum_size: int = 500,
+    ) -> None:
+        self.app = app
+        self.exclude_paths = exclude_paths
+        self.gzip_app = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        await self.gzip_app(scope, receive, send)
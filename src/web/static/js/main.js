@@ -12,6 +12,16 @@ const USE_STREAMING = true;
 let activeStreamController = null;
 let scrollPending = false;
 
+// 接続が切れた場合は Last-Event-ID で再接続し、取りこぼしたイベントから再開する
+const STREAM_MAX_RETRIES = 5;
+const STREAM_RETRY_DELAY_MS = 1000;
+
+// 入力中の履歴 prefill（サーバー側で OLLAMA_PREFILL=1 のときのみ有効）
+const USE_PREFILL = document.body.dataset.prefill === 'true';
+const PREFILL_DEBOUNCE_MS = 800;
+let prefillTimer = null;
+let prefillController = null;
+
 function scrollToBottom() {
     chatContainer.scrollTop = chatContainer.scrollHeight;
 }
@@ -37,6 +47,45 @@ autoResizeTextarea();
 // 入力時に高さを調整
 input.addEventListener('input', autoResizeTextarea);
 
+function cancelPrefill() {
+    if (prefillTimer) {
+        clearTimeout(prefillTimer);
+        prefillTimer = null;
+    }
+    if (prefillController) {
+        prefillController.abort();
+        prefillController = null;
+    }
+}
+
+// 入力が止まったタイミングで履歴を先行評価させ、送信時の待ち時間を減らす
+// 入力のたびに実行中の prefill は中断しない（履歴は変わらないため、そのまま評価を続けさせる）。
+// fetch の中断（cancelPrefill）はサーバー側で検知され、Ollama への prefill も打ち切られる。
+function schedulePrefill() {
+    if (!USE_PREFILL) return;
+    if (prefillTimer) {
+        clearTimeout(prefillTimer);
+        prefillTimer = null;
+    }
+    if (!input.value.trim() || form.classList.contains('is-loading')) return;
+
+    prefillTimer = setTimeout(() => {
+        prefillTimer = null;
+        if (prefillController) return;
+        const controller = new AbortController();
+        prefillController = controller;
+        fetch('/chat/prefill', { method: 'POST', signal: controller.signal })
+            .catch(() => {})
+            .finally(() => {
+                if (prefillController === controller) {
+                    prefillController = null;
+                }
+            });
+    }, PREFILL_DEBOUNCE_MS);
+}
+
+input.addEventListener('input', schedulePrefill);
+
 if (imagePicker && imageInput) {
     imagePicker.addEventListener('click', () => {
         imageInput.click();
@@ -198,6 +247,16 @@ function getLastLines(text, lineCount) {
     return lines.slice(Math.max(lines.length - lineCount, 0)).join('\n');
 }
 
+// 停止操作時はサーバー側の生成も止める（切断だけでは猶予期間中は生成が続くため）
+// ストリームIDは応答の最初の start イベントで受け取るため、最初のトークンより前でも停止できる
+function cancelStream(eventId) {
+    const streamId = (eventId || '').split(':')[0];
+    if (!streamId) return;
+    const body = new FormData();
+    body.set('stream_id', streamId);
+    fetch('/chat/stream/cancel', { method: 'POST', body }).catch(() => {});
+}
+
 async function streamChat(formData) {
     if (activeStreamController) {
         activeStreamController.abort();
@@ -212,6 +271,8 @@ async function streamChat(formData) {
 
     let responseText = '';
     let thinkingText = '';
+    let lastEventId = '';
+    let streamEnded = false;
 
     responseBubble.classList.add('streaming');
     setLoading(true);
@@ -251,13 +312,23 @@ async function streamChat(formData) {
     const handlePayload = (payload) => {
         if (!payload || !payload.type) return;
 
-        if (payload.type === 'thinking') {
+        if (payload.type === 'start') {
+            // ストリームIDの通知のみ（イベントIDは processBuffer で記録済み）
+            return;
+        } else if (payload.type === 'thinking') {
             thinkingText += payload.content || '';
             updateThinking();
         } else if (payload.type === 'response') {
             responseText += payload.content || '';
             updateResponse();
+        } else if (payload.type === 'snapshot') {
+            // 再送できない範囲がある場合は、それまでの全文で置き換える
+            thinkingText = payload.thinking || '';
+            responseText = payload.response || '';
+            updateThinking();
+            updateResponse();
         } else if (payload.type === 'error') {
+            streamEnded = true;
             responseText = payload.content || 'エラーが発生しました。';
             responseBubble.classList.add('assistant-error');
             updateResponse();
@@ -269,9 +340,13 @@ async function streamChat(formData) {
         const remainder = events.pop() || '';
 
         events.forEach((eventChunk) => {
-            const dataLines = eventChunk
-                .split('\n')
-                .filter(line => line.startsWith('data:'));
+            const lines = eventChunk.split('\n');
+            const idLine = lines.find(line => line.startsWith('id:'));
+            if (idLine) {
+                lastEventId = idLine.slice(3).trim();
+            }
+
+            const dataLines = lines.filter(line => line.startsWith('data:'));
 
             if (!dataLines.length) return;
 
@@ -284,6 +359,7 @@ async function streamChat(formData) {
             try {
                 const payload = JSON.parse(dataText);
                 if (payload.type === 'done') {
+                    streamEnded = true;
                     return;
                 }
                 handlePayload(payload);
@@ -295,13 +371,7 @@ async function streamChat(formData) {
         return remainder;
     };
 
-    try {
-        const response = await fetch('/chat/stream', {
-            method: 'POST',
-            body: formData,
-            signal: controller.signal
-        });
-
+    const readStream = async (response) => {
         if (!response.ok || !response.body) {
             throw new Error(`サーバーとの通信に失敗しました (HTTP ${response.status})`);
         }
@@ -320,10 +390,45 @@ async function streamChat(formData) {
         if (buffer.trim()) {
             processBuffer(buffer);
         }
+    };
+
+    const openStream = (attempt) => {
+        if (attempt === 0) {
+            return fetch('/chat/stream', {
+                method: 'POST',
+                body: formData,
+                signal: controller.signal
+            });
+        }
+        return fetch('/chat/stream/resume', {
+            headers: { 'Last-Event-ID': lastEventId },
+            signal: controller.signal
+        });
+    };
+
+    try {
+        for (let attempt = 0; ; attempt++) {
+            try {
+                await readStream(await openStream(attempt));
+            } catch (error) {
+                if (error.name === 'AbortError' || !lastEventId || attempt >= STREAM_MAX_RETRIES) {
+                    throw error;
+                }
+                console.warn('SSE connection lost, retrying:', error);
+            }
+
+            // 完了・エラーを受信したか、再接続に必要なIDがなければ終了
+            if (streamEnded || !lastEventId) break;
+            if (attempt >= STREAM_MAX_RETRIES) {
+                throw new Error('サーバーとの接続が切断されました');
+            }
+            await new Promise(resolve => setTimeout(resolve, STREAM_RETRY_DELAY_MS * (attempt + 1)));
+        }
     } catch (error) {
         responseBubble.classList.remove('streaming');
         responseBubble.classList.add('assistant-error');
         if (error.name === 'AbortError') {
+            cancelStream(lastEventId);
             responseBubble.textContent = 'ストリーミングが中断されました。';
         } else {
             responseBubble.textContent = `エラーが発生しました: ${error.message || error}`;
@@ -347,6 +452,8 @@ function handleStreamingSubmit(evt) {
     const hasImages = imageInput && imageInput.files && imageInput.files.length > 0;
     if (!message && !hasImages) return;
 
+    cancelPrefill();
+
     const previewUrls = getPreviewSources();
 
     appendUserMessage(message, previewUrls);
@@ -392,6 +499,8 @@ form.addEventListener('htmx:beforeRequest', function (evt) {
         return;
     }
 
+    cancelPrefill();
+
     const previewUrls = getPreviewSources();
 
     // ユーザーメッセージのHTMLテンプレート（partials/chat_history.htmlと同じ構造）
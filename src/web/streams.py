@@ -0,0 +1,324 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from src.core.session_backend import SessionBackend
+
+# ストリームの状態（完了したか、スナップショット）を保持する名前空間
+STREAM_NAMESPACE = "streams"
+# 接続中のクライアントが最後に確認された時刻を保持する名前空間
+STREAM_SEEN_NAMESPACE = "stream_seen"
+
+
+def format_event(stream_id: str, seq: int, payload: Dict[str, Any]) -> str:
+    data = json.dumps(payload, ensure_ascii=False)
+    return f"id: {stream_id}:{seq}\ndata: {data}\n\n"
+
+
+class GenerationStream:
+    """
+    1回の生成で発生した SSE イベントを連番付きで SessionBackend に書き込む。
+
+    クライアントの接続とは独立して書き込まれるため、切断後も猶予期間内であれば
+    Last-Event-ID を使って取りこぼしたイベントから再開できる。保存先を共有していれば、
+    再接続が別のワーカーに振り分けられても続きを受信できる。
+
+    SQLite では書き込みの競合時に busy_timeout まで待つことがあるため、
+    保存先の読み書きはスレッドプールで行い、イベントループを塞がない。
+    """
+
+    # is_current・接続状態の確認の最小間隔（秒）。チャンクごとに保存先を読まないよう間引く
+    CHECK_INTERVAL = 0.5
+
+    def __init__(
+        self,
+        stream_id: str,
+        backend: SessionBackend,
+        buffer_size: int,
+        grace_period: float,
+        is_current: Optional[Callable[[], bool]] = None,
+    ) -> None:
+        """
+        Args:
+            stream_id: ストリームID（イベントIDの前半）
+            backend: イベントの保存先
+            buffer_size: 再送用に保持するイベント数の目安
+            grace_period: 接続がない状態で生成を続ける秒数
+            is_current: 生成を続けてよいか（ターンが終わっていないか）を返す関数
+        """
+        self.stream_id = stream_id
+        self.grace_period = grace_period
+        self.last_seq = 0
+        self.finished = False
+        self.cancelled = False
+        # このワーカーで接続中のクライアント数
+        self.subscribers = 0
+        self.task: Optional["asyncio.Task[None]"] = None
+        # 削除したイベントを補うためのスナップショット用に全文を保持する
+        self.thinking: List[str] = []
+        self.response: List[str] = []
+        self._backend = backend
+        self._state = backend.mapping(STREAM_NAMESPACE)
+        self._seen = backend.mapping(STREAM_SEEN_NAMESPACE)
+        self._snapshot_interval = max(buffer_size // 2, 1)
+        self._is_current = is_current
+        self._checked_at = time.monotonic()
+        # 最初の接続が来ないまま放置された場合も猶予期間で打ち切れるよう、生成時点から数える
+        self._seen_at = time.time()
+        self._changed = asyncio.Condition()
+        # 実行中の Ollama へのリクエストの接続を閉じる関数（OllamaClient.chat_stream から登録される）
+        self._abort: Optional[Callable[[], None]] = None
+
+    async def publish(self, payload: Dict[str, Any]) -> None:
+        chunk_type = payload.get("type")
+        if chunk_type == "thinking":
+            self.thinking.append(payload.get("content", ""))
+        elif chunk_type == "response":
+            self.response.append(payload.get("content", ""))
+
+        async with self._changed:
+            self.last_seq += 1
+            await run_in_threadpool(self._write_event, self.last_seq, payload)
+            self._changed.notify_all()
+
+    def _write_event(self, seq: int, payload: Dict[str, Any]) -> None:
+        self._backend.append_event(self.stream_id, seq, format_event(self.stream_id, seq, payload))
+        if seq % self._snapshot_interval == 0:
+            self._save_snapshot()
+
+    def _save_snapshot(self) -> None:
+        """
+        現時点の全文をスナップショットとして保存し、前回のスナップショット以前のイベントを削除する。
+        読み取り側はイベント → 状態の順に読むため、状態を先に書いてからイベントを削除する。
+        """
+        state = self._state[self.stream_id]
+        previous = state["snapshot"]
+        state["snapshot"] = {
+            "seq": self.last_seq,
+            "thinking": "".join(self.thinking),
+            "response": "".join(self.response),
+        }
+        if previous is not None:
+            state["trimmed"] = previous["seq"]
+        self._state[self.stream_id] = state
+        if previous is not None:
+            self._backend.delete_events(self.stream_id, previous["seq"])
+
+    async def finish(self) -> None:
+        async with self._changed:
+            self.finished = True
+            await run_in_threadpool(self._mark_finished)
+            self._changed.notify_all()
+
+    def _mark_finished(self) -> None:
+        state = self._state[self.stream_id]
+        state["finished"] = True
+        self._state[self.stream_id] = state
+
+    async def wait_changed(self, cursor: int, timeout: float) -> None:
+        """cursor より後のイベントが追加されるか完了するまで、最大 timeout 秒待つ"""
+        async with self._changed:
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait_for(lambda: self.finished or self.last_seq > cursor),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def register_abort(self, abort: Callable[[], None]) -> None:
+        self._abort = abort
+        # 登録前に中断が要求されていた場合はここで閉じる
+        if self.cancelled:
+            abort()
+
+    def cancel(self) -> None:
+        """生成を中断する。プロンプト評価中で行が届いていなくても、接続を閉じて打ち切る"""
+        self.cancelled = True
+        abort = self._abort
+        if abort is not None:
+            abort()
+
+    async def watch(self) -> None:
+        """
+        生成中に abandoned を定期的に確認し、該当すれば cancel する。
+        プロンプト評価中は should_stop が呼ばれないため、停止操作・後続のメッセージ・猶予期間の
+        経過をここで検知して Ollama の処理を空ける。
+        """
+        while not self.finished:
+            if await run_in_threadpool(self.abandoned):
+                self.cancel()
+                return
+            await asyncio.sleep(self.CHECK_INTERVAL)
+
+    def abandoned(self) -> bool:
+        """
+        中断要求・ターンの終了があったか、どのワーカーにも接続がないまま猶予期間を過ぎたか。
+        保存先を読むことがあるため、イベントループからはスレッドプール経由で呼び出す。
+        """
+        if self.cancelled:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at >= self.CHECK_INTERVAL:
+            self._checked_at = now
+            if self._is_current is not None and not self._is_current():
+                self.cancelled = True
+                return True
+            self._seen_at = max(self._seen_at, self._seen.get(self.stream_id, 0.0))
+        if self.subscribers > 0:
+            return False
+        return time.time() - self._seen_at > self.grace_period
+
+
+class StreamRegistry:
+    """
+    進行中・完了直後のストリームを管理する。
+    生成はそれを開始したワーカーで行い、配信（再接続を含む）はどのワーカーからでも行える。
+    """
+
+    # 接続中であることを記録する間隔（秒）
+    HEARTBEAT_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        backend: SessionBackend,
+        buffer_size: int = 1024,
+        grace_period: float = 30.0,
+        poll_interval: float = 0.1,
+    ) -> None:
+        """
+        Args:
+            backend: イベントの保存先（複数ワーカーではワーカー間で共有できるもの）
+            buffer_size: 再送用に保持するイベント数の目安
+            grace_period: 接続がない状態で生成を続ける秒数、および完了後に再接続を受け付ける秒数
+            poll_interval: 他のワーカーで生成中のストリームを配信する際の確認間隔（秒）
+        """
+        self.buffer_size = buffer_size
+        self.grace_period = grace_period
+        self.poll_interval = poll_interval
+        self._backend = backend
+        self._state = backend.mapping(STREAM_NAMESPACE)
+        self._seen = backend.mapping(STREAM_SEEN_NAMESPACE)
+        self._streams: Dict[str, GenerationStream] = {}
+
+    async def create(
+        self,
+        stream_id: Optional[str] = None,
+        is_current: Optional[Callable[[], bool]] = None,
+    ) -> GenerationStream:
+        stream = GenerationStream(
+            stream_id or uuid.uuid4().hex,
+            self._backend,
+            self.buffer_size,
+            self.grace_period,
+            is_current=is_current,
+        )
+        await run_in_threadpool(
+            self._state.__setitem__, stream.stream_id, {"finished": False, "trimmed": 0, "snapshot": None}
+        )
+        self._streams[stream.stream_id] = stream
+        return stream
+
+    def get(self, stream_id: str) -> Optional[GenerationStream]:
+        """このワーカーで生成中・完了直後のストリームを返す"""
+        return self._streams.get(stream_id)
+
+    async def exists(self, stream_id: str) -> bool:
+        """いずれかのワーカーで生成中・完了直後のストリームか"""
+        if stream_id in self._streams:
+            return True
+        return await run_in_threadpool(self._state.get, stream_id) is not None
+
+    def _read(self, stream_id: str, cursor: int) -> Tuple[List[Tuple[int, str]], Optional[Dict[str, Any]]]:
+        # スナップショット作成時の削除と競合しないよう、イベント → 状態の順に読む
+        events = self._backend.load_events(stream_id, cursor)
+        return events, self._state.get(stream_id)
+
+    def _touch(self, stream_id: str) -> None:
+        self._seen[stream_id] = time.time()
+
+    async def subscribe(self, stream_id: str, last_seq: int = 0) -> AsyncIterator[str]:
+        """
+        last_seq より後のイベントを再送し、その後は生成に追従して送信する。
+        再送すべきイベントがすでに削除されている場合は、
+        スナップショットの全文を snapshot イベントとして送ってから続きを送る。
+        """
+        local = self._streams.get(stream_id)
+        if local is not None:
+            local.subscribers += 1
+        heartbeat_at = 0.0
+        state: Optional[Dict[str, Any]] = None
+        try:
+            cursor = last_seq
+            drained = False
+            while True:
+                events, state = await run_in_threadpool(self._read, stream_id, cursor)
+                if state is None:
+                    return
+
+                now = time.monotonic()
+                if now - heartbeat_at >= self.HEARTBEAT_INTERVAL:
+                    heartbeat_at = now
+                    await run_in_threadpool(self._touch, stream_id)
+
+                snapshot = state["snapshot"]
+                if cursor < state["trimmed"] and snapshot is not None:
+                    cursor = snapshot["seq"]
+                    yield format_event(stream_id, cursor, {
+                        "type": "snapshot",
+                        "thinking": snapshot["thinking"],
+                        "response": snapshot["response"],
+                    })
+
+                for seq, event in events:
+                    if seq > cursor:
+                        cursor = seq
+                        yield event
+
+                if drained:
+                    return
+                if state["finished"]:
+                    # 完了の記録より前に追加されたイベントを取りこぼさないよう、もう一度だけ読む
+                    drained = True
+                    continue
+
+                if local is not None:
+                    await local.wait_changed(cursor, self.HEARTBEAT_INTERVAL)
+                else:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            if local is not None:
+                local.subscribers -= 1
+            # 切断時刻から猶予期間を数える。切断時はキャンセル済みで await できないため、完了を待たずに投げる
+            if state is not None:
+                asyncio.get_running_loop().run_in_executor(None, self._touch, stream_id)
+
+    def discard_later(self, stream: GenerationStream) -> None:
+        """完了後も猶予期間だけ再接続を受け付け、その後に破棄する"""
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.grace_period, self._discard, loop, stream.stream_id)
+        logging.debug("Stream %s finished; kept for %.0f s", stream.stream_id, self.grace_period)
+
+    def _discard(self, loop: asyncio.AbstractEventLoop, stream_id: str) -> None:
+        self._streams.pop(stream_id, None)
+        loop.run_in_executor(None, self._delete, stream_id)
+
+    def _delete(self, stream_id: str) -> None:
+        self._state.pop(stream_id, None)
+        self._seen.pop(stream_id, None)
+        self._backend.delete_events(stream_id)
+
+    @staticmethod
+    def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[str, int]]:
+        """Last-Event-ID（"<stream_id>:<seq>"）を分解する"""
+        if not event_id:
+            return None
+        stream_id, _, seq = event_id.strip().partition(":")
+        if not stream_id or not seq.isdigit():
+            return None
+        return stream_id, int(seq)